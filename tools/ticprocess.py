@@ -13,16 +13,24 @@
 # - vérifie la puissance apparente soutirée actuelle et publie via MQTT un statut de délestage suivant que la valeur VA_THRESH est dépassée ou non
 # Permet par exemple de piloter une demande de délestage via MQTT tout en enregistrant les données avec telegraf
 # Exemple d'utilisation: stdbuf -oL tic2json -d | ticprocess.py
+# Le script ne dépend que de la bibliothèque standard et de paho-mqtt et peut être exécuté avec PyPy: ... | pypy3 ticprocess.py
+# (non testé avec PyPy lorsque UDP_BATCH > 1: l'envoi groupé via sendmmsg repose sur ctypes)
 
+import os
+import re
+import errno
 import sys
 import socket
-import json
-import paho.mqtt.publish as publish
+import ctypes
+import atexit
+from itertools import cycle
+import paho.mqtt.client as mqtt
 
 
 # Configuration variables
-UDP_IP = "grafana"		# adresse où envoyer le paquet UDP
+UDP_IP = "grafana"		# adresse où envoyer le paquet UDP (résolue une seule fois au démarrage)
 UDP_PORT = 8094			# port UDP
+UDP_BATCH = 1			# nombre de trames envoyées par appel système (sendmmsg sous Linux, 1 trame par paquet)
 MQTT_BROKER = "hap-acl"		# adresse du broker MQTT
 MQTT_TOPIC = "energy/delest"	# topic MQTT
 MQTT_SKIP = 10			# nombre de trames à ignorer entre chaque publication MQTT
@@ -30,29 +38,105 @@ ETIQ_POWER = "SINSTS"		# en mono: TICv1: "PAPP", TICv2: "SINSTS"
 VA_THRESH = 8900		# valeur limite de la puissance apparente (en VA)
 
 
+# structures C pour sendmmsg(2)
+class iovec(ctypes.Structure):
+	_fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+	_fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+		    ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+		    ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+		    ("msg_flags", ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+	_fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+# charges utiles MQTT précalculées (identiques à la conversion faite par paho)
+MQTT_PAYLOADS = { True: b"True", False: b"False", None: None }
+
+# extraction directe depuis la sortie dictionnaire de tic2json, sans décodage JSON
+RE_TVALIDE = re.compile(rb'"_tvalide": 1')
+RE_POWER = re.compile(rb'"' + re.escape(ETIQ_POWER.encode()) + rb'": \{ "data": (\d+)')
+
 def over_vatresh(ticjsonline):
 	state = None
-	try:
-		tic = json.loads(ticjsonline)
-		s = tic.get(ETIQ_POWER)
-		v = tic.get("_tvalide")
-
-		if v and s:
-			if s.get("data") > VA_THRESH:
-				state = True
-			else:
-				state = False
-	except:
-		pass
+	if RE_TVALIDE.search(ticjsonline):
+		m = RE_POWER.search(ticjsonline)
+		if m:
+			state = int(m.group(1)) > VA_THRESH
 	return state
 
+def udp_sendmmsg_setup():
+	if UDP_BATCH < 2 or not sys.platform.startswith("linux"):
+		return None
+	sendmmsg = getattr(ctypes.CDLL(None, use_errno=True), "sendmmsg", None)
+	if not sendmmsg:
+		return None
+	sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+	sendmmsg.restype = ctypes.c_int
+	for i in range(UDP_BATCH):
+		msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+		msgs[i].msg_hdr.msg_iovlen = 1
+	return sendmmsg
+
+def udp_flush():
+	n = len(pending)
+	if not n:
+		return
+	if udp_sendmmsg:
+		for iov, frame in zip(iovs, pending):
+			iov.iov_base = ctypes.cast(frame, ctypes.c_void_p)
+			iov.iov_len = len(frame)
+		sent = 0
+		while sent < n:
+			ret = udp_sendmmsg(udp_fd, ctypes.addressof(msgs[sent]), n - sent, 0)
+			if ret < 0:
+				err = ctypes.get_errno()
+				if err == errno.EINTR:
+					continue
+				if err == errno.ECONNREFUSED:	# récepteur absent: trame perdue, comme avec sock.send()
+					sent += 1
+					continue
+				raise OSError(err, os.strerror(err))
+			sent += ret
+	else:
+		for frame in pending:
+			try:
+				udp_send(frame)
+			except ConnectionRefusedError:	# récepteur absent (ICMP port unreachable)
+				pass
+	pending.clear()
+
+def mqtt_close():
+	client.disconnect()
+	client.loop_stop()
+
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-skip = 0
-
-for ticjsonline in sys.stdin:
-	sock.sendto(bytes(ticjsonline, "utf-8"), (UDP_IP, UDP_PORT))
-	delest = over_vatresh(ticjsonline)
-	if not skip:
-		publish.single(MQTT_TOPIC, delest, hostname=MQTT_BROKER)
-		skip = MQTT_SKIP
-	skip -= 1
+sock.connect((socket.gethostbyname(UDP_IP), UDP_PORT))
+udp_send = sock.send
+udp_fd = sock.fileno()
+iovs = (iovec * UDP_BATCH)()
+msgs = (mmsghdr * UDP_BATCH)()
+udp_sendmmsg = udp_sendmmsg_setup()
+pending = []
+
+if hasattr(mqtt, "CallbackAPIVersion"):	# paho-mqtt >= 2.0
+	client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+else:
+	client = mqtt.Client()
+client.connect_async(MQTT_BROKER)
+client.loop_start()
+atexit.register(mqtt_close)
+mqtt_publish = client.publish
+
+mqtt_due = cycle([True] + [False] * (MQTT_SKIP - 1)).__next__
+
+for ticjsonline in iter(sys.stdin.buffer.readline, b''):
+	pending.append(ticjsonline)
+	if len(pending) >= UDP_BATCH:
+		udp_flush()
+	if mqtt_due():
+		delest = over_vatresh(ticjsonline)
+		mqtt_publish(MQTT_TOPIC, MQTT_PAYLOADS[delest], qos=0)
+
+udp_flush()